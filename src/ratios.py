@@ -1,12 +1,21 @@
 """
 Compute financial ratios using Yahoo Finance and Okama.
 """
+import os
 import time
 import logging
+from datetime import date, timedelta
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+import requests
 import yfinance as yf
 import okama as ok
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from joblib import Memory
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tools import CACHE_DIR
 
 # Policy variable: change this to use a different baseline year.
 DEFAULT_YEAR = "2023"
@@ -16,33 +25,90 @@ PRIOR_YEAR = str(int(DEFAULT_YEAR) - 1)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def fetch_financial_data(ticker_symbol):
+# Statement line items used by compute_ratio_frame, per statement.
+LINE_ITEMS = {
+    "income_stmt": ["Net Income", "Total Revenue", "Cost Of Revenue", "Diluted EPS", "EBIT", "Interest Expense"],
+    "balance_sheet": [
+        "Total Assets", "Stockholders Equity", "Current Assets", "Current Liabilities", "Inventory",
+        "Cash And Cash Equivalents", "Accounts Receivable", "Total Liabilities Net Minority Interest",
+    ],
+    "cash_flow": ["Cash Dividends Paid"],
+}
+# Balance sheet items that are averaged with PRIOR_YEAR.
+PRIOR_LINE_ITEMS = ["Inventory", "Accounts Receivable"]
+
+# Concurrent ticker downloads; Yahoo starts rate limiting (429) well below 10.
+MAX_WORKERS = 4
+
+# Shared HTTP session: keeps connections alive across tickers and worker threads
+# so each Yahoo request does not pay for a fresh TCP/TLS handshake.
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive"})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=5, backoff_factor=1.0, status_forcelist=[429, 502, 503]),
+))
+
+# Downloaded statements and prices are cached on disk, in their own store under the
+# shared cache directory. Entries are keyed on the calendar day, so reruns on the same
+# day skip Yahoo/okama entirely; entries older than a day are dropped at import so
+# earlier days do not pile up.
+DAILY_CACHE_MAX_AGE = timedelta(days=1)
+daily_memory = Memory(os.path.join(CACHE_DIR, "daily"), verbose=0)
+daily_memory.reduce_size(age_limit=DAILY_CACHE_MAX_AGE)
+
+@lru_cache(maxsize=None)
+@daily_memory.cache(ignore=["session"])
+def _download_financial_data(ticker_symbol, day, session=SESSION):
     """
-    Fetch balance sheet, income statement, and cash flow data for a given ticker.
+    Download the financial statements and adjusted close prices for a ticker.
     
     Parameters:
         ticker_symbol (str): The ticker symbol.
+        day (str): ISO date the download belongs to; part of the cache key.
+        session (requests.Session): HTTP session shared across requests.
         
     Returns:
-        tuple: (income_stmt, balance_sheet, cash_flow, tick, stock)
+        tuple: (income_stmt, balance_sheet, cash_flow, info, adj_close)
     """
-    try:
-        tick = yf.Ticker(ticker_symbol)
-        balance_sheet = tick.balance_sheet
-        income_stmt = tick.income_stmt
-        cash_flow = tick.cashflow
-        
-        if balance_sheet.empty or income_stmt.empty or cash_flow.empty:
-            raise ValueError(f"Financial statements not available for {ticker_symbol}")
+    tick = yf.Ticker(ticker_symbol, session=session)
+    balance_sheet = tick.balance_sheet
+    income_stmt = tick.income_stmt
+    cash_flow = tick.cashflow
+    info = tick.info
+    
+    if balance_sheet.empty or income_stmt.empty or cash_flow.empty:
+        raise ValueError(f"Financial statements not available for {ticker_symbol}")
 
-        # Optional: Rename columns if necessary
-        income_stmt.rename(columns={"" : "Account"}, inplace=True)
+    # Optional: Rename columns if necessary
+    income_stmt.rename(columns={"" : "Account"}, inplace=True)
+    
+    # Only the price series is kept; the okama Asset itself does not pickle.
+    adj_close = ok.Asset(ticker_symbol + ".US").adj_close
+    return income_stmt, balance_sheet, cash_flow, info, adj_close
+
+def fetch_financial_data(ticker_symbol, session=SESSION):
+    """
+    Fetch balance sheet, income statement, and cash flow data for a given ticker.
+    
+    Results are cached in memory and on disk for the current day.
+    
+    Parameters:
+        ticker_symbol (str): The ticker symbol.
+        session (requests.Session): HTTP session shared across requests.
         
-        stock = ok.Asset(ticker_symbol + ".US")
+    Returns:
+        tuple: (income_stmt, balance_sheet, cash_flow, info, adj_close)
+    """
+    try:
+        income_stmt, balance_sheet, cash_flow, info, adj_close = _download_financial_data(
+            ticker_symbol, date.today().isoformat(), session=session
+        )
     except Exception as e:
         logger.error(f"Error fetching financial data for {ticker_symbol}: {e}")
         raise
-    return income_stmt, balance_sheet, cash_flow, tick, stock
+    return income_stmt, balance_sheet, cash_flow, info, adj_close
 
 def extract_value(df, row, col):
     """
@@ -58,141 +124,196 @@ def extract_value(df, row, col):
     Returns:
         value: The extracted value or pd.NA if not found.
     """
+    # Look labels up directly instead of using exceptions for control flow
+    if row not in df.index:
+        logger.warning(f"Missing data for {row} in {col}")
+        return pd.NA
     try:
-        value = df.loc[row, col].iloc[0]
-    except Exception as e:
-        logger.warning(f"Missing data for {row} in {col}: {e}")
+        col_loc = df.columns.get_loc(col)
+    except KeyError:
+        logger.warning(f"Missing data for {row} in {col}")
+        return pd.NA
+    values = np.ravel(df.to_numpy()[df.index.get_loc(row), col_loc])
+    if len(values) == 0 or pd.isna(values[0]):
         return pd.NA
-    return value
+    return values[0]
 
-def safe_div(numerator, denominator):
+def _statement_values(statement, items, year):
     """
-    Performs safe division: if numerator or denominator is NA or denominator==0,
-    returns pd.NA.
+    Helper function to pull several line items for one year from a statement.
+    
+    Missing line items (or a missing year) come back as NaN.
+    
+    Parameters:
+        statement (DataFrame): Financial statement with line items as rows and dates as columns.
+        items (list): Row labels to extract.
+        year (str): Year of the column to use; the first matching column is taken.
+        
+    Returns:
+        Series: Values indexed by line item.
     """
     try:
-        if pd.isna(numerator) or pd.isna(denominator) or denominator == 0:
-            return pd.NA
-        return numerator / denominator
-    except Exception as e:
-        logger.warning(f"Division error: {e}")
-        return pd.NA
+        values = statement.T.loc[year].iloc[0]
+    except (KeyError, IndexError) as e:
+        logger.warning(f"Missing data for {year}: {e}")
+        return pd.Series(float("nan"), index=items)
+    values = values.reindex(items)
+    missing = values.index[values.isna()].tolist()
+    if missing:
+        logger.warning(f"Missing data for {missing} in {year}")
+    return values
 
-def compute_ratios(ticker_symbol):
+def fetch_line_items(ticker_symbol, session=SESSION):
     """
-    Computes financial ratios based on fetched financial statements.
-    Missing components are replaced with NA.
+    Fetches the raw inputs needed by compute_ratio_frame for a single ticker.
     
     Parameters:
         ticker_symbol (str): The ticker symbol of the stock.
+        session (requests.Session): HTTP session shared across requests.
         
     Returns:
-        dict: Dictionary of computed ratios.
+        Series: Statement line items for DEFAULT_YEAR, the PRIOR_YEAR items
+                (suffixed with " Prior"), "Price" and "Shares Outstanding".
     """
-    income_stmt, balance_sheet, cash_flow, tick, stock = fetch_financial_data(ticker_symbol)
-    results = {}
+    income_stmt, balance_sheet, cash_flow, info, adj_close = fetch_financial_data(ticker_symbol, session=session)
+
     try:
-        # Profitability
-        net_income = extract_value(income_stmt, "Net Income", DEFAULT_YEAR)
-        revenue = extract_value(income_stmt, "Total Revenue", DEFAULT_YEAR)
-        results["net_profit_margin"] = safe_div(net_income, revenue)
+        market_price_per_share = adj_close.iloc[-1]
+    except Exception as e:
+        logger.warning(f"Market price error for {ticker_symbol}: {e}")
+        market_price_per_share = float("nan")
 
-        cogs = extract_value(income_stmt, "Cost Of Revenue", DEFAULT_YEAR)
-        revenue_minus_cogs = (revenue - cogs) if (not pd.isna(revenue) and not pd.isna(cogs)) else pd.NA
-        results["gross_profit_margin"] = safe_div(revenue_minus_cogs, revenue)
+    shares_outstanding = info.get('sharesOutstanding')
+    if shares_outstanding is None:
+        logger.warning("sharesOutstanding not found in ticker.info")
+        shares_outstanding = float("nan")
 
-        total_assets = extract_value(balance_sheet, "Total Assets", DEFAULT_YEAR)
-        results["roa"] = safe_div(net_income, total_assets)
+    return pd.concat([
+        _statement_values(income_stmt, LINE_ITEMS["income_stmt"], DEFAULT_YEAR),
+        _statement_values(balance_sheet, LINE_ITEMS["balance_sheet"], DEFAULT_YEAR),
+        _statement_values(cash_flow, LINE_ITEMS["cash_flow"], DEFAULT_YEAR),
+        _statement_values(balance_sheet, PRIOR_LINE_ITEMS, PRIOR_YEAR).add_suffix(" Prior"),
+        pd.Series({"Price": market_price_per_share, "Shares Outstanding": shares_outstanding}),
+    ])
 
-        stockholders_equity = extract_value(balance_sheet, "Stockholders Equity", DEFAULT_YEAR)
-        results["roe"] = safe_div(net_income, stockholders_equity)
+def compute_ratio_frame(fin):
+    """
+    Computes financial ratios for many tickers at once.
+    Missing components (and zero denominators) yield NaN.
+    
+    Parameters:
+        fin (DataFrame): One row per ticker, one column per input as returned by fetch_line_items.
+        
+    Returns:
+        DataFrame: One row per ticker, one column per ratio.
+    """
+    fin = fin.apply(pd.to_numeric, errors="coerce")
 
-        # Liquidity
-        current_assets = extract_value(balance_sheet, "Current Assets", DEFAULT_YEAR)
-        current_liabilities = extract_value(balance_sheet, "Current Liabilities", DEFAULT_YEAR)
-        results["current_ratio"] = safe_div(current_assets, current_liabilities)
+    def div(numerator, denominator):
+        return numerator / denominator.where(denominator != 0)
 
-        inventory = extract_value(balance_sheet, "Inventory", DEFAULT_YEAR)
-        current_minus_inventory = (current_assets - inventory) if (not pd.isna(current_assets) and not pd.isna(inventory)) else pd.NA
-        results["quick_ratio"] = safe_div(current_minus_inventory, current_liabilities)
+    net_income = fin["Net Income"]
+    revenue = fin["Total Revenue"]
+    cogs = fin["Cost Of Revenue"]
+    total_assets = fin["Total Assets"]
+    stockholders_equity = fin["Stockholders Equity"]
+    current_assets = fin["Current Assets"]
+    current_liabilities = fin["Current Liabilities"]
+    inventory = fin["Inventory"]
+    total_liabilities = fin["Total Liabilities Net Minority Interest"]
+    price = fin["Price"]
+    shares_outstanding = fin["Shares Outstanding"]
 
-        cash_and_cash_equivalents = extract_value(balance_sheet, "Cash And Cash Equivalents", DEFAULT_YEAR)
-        results["cash_ratio"] = safe_div(cash_and_cash_equivalents, current_liabilities)
+    # Efficiency ratios average the current and PRIOR_YEAR balances
+    average_inventory = (inventory + fin["Inventory Prior"]) / 2
+    average_accounts_receivable = (fin["Accounts Receivable"] + fin["Accounts Receivable Prior"]) / 2
+    book_value_per_share = div(stockholders_equity, shares_outstanding)
+    dividends_per_share = div(fin["Cash Dividends Paid"], shares_outstanding)
 
-        # Efficiency (using previous year's data from PRIOR_YEAR)
-        inventory_prior = extract_value(balance_sheet, "Inventory", PRIOR_YEAR)
-        average_inventory = safe_div((inventory + inventory_prior) if (not pd.isna(inventory) and not pd.isna(inventory_prior)) else pd.NA, 2)
-        results["inventory_turnover"] = safe_div(cogs, average_inventory)
+    return pd.DataFrame({
+        # Profitability
+        "net_profit_margin": div(net_income, revenue),
+        "gross_profit_margin": div(revenue - cogs, revenue),
+        "roa": div(net_income, total_assets),
+        "roe": div(net_income, stockholders_equity),
+        # Liquidity
+        "current_ratio": div(current_assets, current_liabilities),
+        "quick_ratio": div(current_assets - inventory, current_liabilities),
+        "cash_ratio": div(fin["Cash And Cash Equivalents"], current_liabilities),
+        # Efficiency
+        "inventory_turnover": div(cogs, average_inventory),
+        "accounts_receivable_turnover": div(revenue, average_accounts_receivable),
+        "asset_turnover": div(revenue, total_assets),
+        # Market Value
+        "pe_ratio": div(price, fin["Diluted EPS"]),
+        "pb_ratio": div(price, book_value_per_share),
+        "dividend_yield": div(dividends_per_share, price),
+        # Leverage
+        "debt_to_equity": div(total_liabilities, stockholders_equity),
+        "debt_ratio": div(total_liabilities, total_assets),
+        "interest_coverage_ratio": div(fin["EBIT"], fin["Interest Expense"]),
+    }, index=fin.index)
 
-        accounts_receivable_current = extract_value(balance_sheet, "Accounts Receivable", DEFAULT_YEAR)
-        accounts_receivable_prior = extract_value(balance_sheet, "Accounts Receivable", PRIOR_YEAR)
-        average_accounts_receivable = safe_div((accounts_receivable_current + accounts_receivable_prior) if (not pd.isna(accounts_receivable_current) and not pd.isna(accounts_receivable_prior)) else pd.NA, 2)
-        results["accounts_receivable_turnover"] = safe_div(revenue, average_accounts_receivable)
+def compute_ratios(ticker_symbol, session=SESSION):
+    """
+    Computes financial ratios based on fetched financial statements.
+    Missing components are replaced with NaN.
+    
+    Parameters:
+        ticker_symbol (str): The ticker symbol of the stock.
+        session (requests.Session): HTTP session shared across requests.
+        
+    Returns:
+        dict: Dictionary of computed ratios.
+    """
+    fin = fetch_line_items(ticker_symbol, session=session).to_frame(ticker_symbol).T
+    return compute_ratio_frame(fin).iloc[0].to_dict()
 
-        results["asset_turnover"] = safe_div(revenue, total_assets)
+def _process_ticker(ticker_symbol, session=SESSION):
+    start_time = time.time()
+    try:
+        line_items = fetch_line_items(ticker_symbol, session=session)
+        elapsed = time.time() - start_time
+        print(f"Processing {ticker_symbol}... Success in {elapsed:.2f} sec")
+        return line_items, elapsed
+    except Exception as e:
+        elapsed = time.time() - start_time
+        print(f"Processing {ticker_symbol}... Failed in {elapsed:.2f} sec: {e}")
+        return None, elapsed
 
-        # Market Value
-        try:
-            market_price_per_share = stock.adj_close[-1]
-        except Exception as e:
-            logger.warning(f"Market price error for {ticker_symbol}: {e}")
-            market_price_per_share = pd.NA
-        diluted_eps = extract_value(income_stmt, "Diluted EPS", DEFAULT_YEAR)
-        results["pe_ratio"] = safe_div(market_price_per_share, diluted_eps)
-
-        shares_outstanding = tick.info.get('sharesOutstanding', pd.NA)
-        if pd.isna(shares_outstanding):
-            logger.warning("sharesOutstanding not found in ticker.info")
-        book_value_per_share = safe_div(stockholders_equity, shares_outstanding)
-        results["pb_ratio"] = safe_div(market_price_per_share, book_value_per_share)
-
-        dividends_paid = extract_value(cash_flow, "Cash Dividends Paid", DEFAULT_YEAR)
-        dividends_per_share = safe_div(dividends_paid, shares_outstanding)
-        results["dividend_yield"] = safe_div(dividends_per_share, market_price_per_share)
+def _ratio_records(rows, elapsed_by_ticker):
+    if not rows:
+        return []
+    # Compute every ratio for every ticker in one vectorized pass
+    ratios = compute_ratio_frame(pd.DataFrame.from_dict(rows, orient="index"))
+    ratios["ticker"] = ratios.index
+    ratios["elapsed"] = ratios.index.map(elapsed_by_ticker)
+    return ratios.to_dict("records")
 
-        # Leverage
-        total_liabilities = extract_value(balance_sheet, "Total Liabilities Net Minority Interest", DEFAULT_YEAR)
-        results["debt_to_equity"] = safe_div(total_liabilities, stockholders_equity)
-        results["debt_ratio"] = safe_div(total_liabilities, total_assets)
+def process_tickers(stocks, session=SESSION):
+    def run_batch(ticker_symbols):
+        error_tickers = []
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(_process_ticker, ticker_symbol, session): ticker_symbol for ticker_symbol in ticker_symbols}
+            for future in as_completed(futures):
+                line_items, elapsed = future.result()
+                if line_items is not None:
+                    rows[futures[future]] = line_items
+                    elapsed_by_ticker[futures[future]] = elapsed
+                else:
+                    error_tickers.append(futures[future])
+        return error_tickers
 
-        ebit = extract_value(income_stmt, "EBIT", DEFAULT_YEAR)
-        interest_expense = extract_value(income_stmt, "Interest Expense", DEFAULT_YEAR)
-        results["interest_coverage_ratio"] = safe_div(ebit, interest_expense)
+    rows = {}
+    elapsed_by_ticker = {}
+    error_tickers = run_batch(stocks['Ticker'].tolist())
 
-    except Exception as e:
-        logger.error(f"Error computing ratios for {ticker_symbol}: {e}")
-    return results
-
-def process_tickers(stocks):
-    def process_ticker(row):
-        ticker_symbol = row['Ticker']
-        start_time = time.time()
-        try:
-            ratios = compute_ratios(ticker_symbol)
-            elapsed = time.time() - start_time
-            ratios['ticker'] = ticker_symbol
-            ratios['elapsed'] = elapsed
-            print(f"Processing {ticker_symbol}... Success in {elapsed:.2f} sec")
-            return ratios, None
-        except Exception as e:
-            elapsed = time.time() - start_time
-            print(f"Processing {ticker_symbol}... Failed in {elapsed:.2f} sec: {e}")
-            return None, ticker_symbol
-    
-    results = []
-    error_tickers = []
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {executor.submit(process_ticker, row): row['Ticker'] for idx, row in stocks.iterrows()}
-        for future in as_completed(futures):
-            res, error = future.result()
-            if res is not None:
-                results.append(res)
-            if error:
-                error_tickers.append(error)
-    
-    return results, error_tickers
+    # Yahoo throttling is transient, so give the failed tickers one more pass
+    if error_tickers:
+        print(f"Retrying {len(error_tickers)} failed tickers...")
+        error_tickers = run_batch(error_tickers)
 
+    return _ratio_records(rows, elapsed_by_ticker), error_tickers
 
 
 if __name__ == "__main__":
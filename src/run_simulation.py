@@ -4,15 +4,27 @@ CLI entry point for building portfolios and running simulations.
 Prerequisite: df_results.csv stored in the same directory as this file, containing composite financial metrics. Currently, you can do this by running the first two cells in portfolios.ipynb.
 """
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 import pandas as pd
 import okama as ok
 import time
 import numpy as np
-from tools import save_portfolio_results
+from tools import load_df_results, save_portfolio_results
 
 # Load your data
-df_results = pd.read_csv("df_results.csv")
+df_results = load_df_results("df_results.csv")
+
+# Policies whose ticker selection does not depend on random_state (nlargest/nsmallest by risk)
+SEED_INVARIANT_POLICIES = {"Base-High", "Base-Low"}
+
+# Sampler used by simulate_return/simulate_bootstrap inside each worker process
+_sampler = None
+
+def _init_worker(sampler):
+    global _sampler
+    _sampler = sampler
 
 # add: helper to parse length strings
 def _parse_length_to_years(length: str) -> float:
@@ -21,70 +33,85 @@ def _parse_length_to_years(length: str) -> float:
     # assume 'y'
     return float(length[:-1])
 
-def ticker_policy(df_results, policy="Industry", sample_size=15, random_state=42):
-    match policy:
-        case "Random":
-            return df_results.sample(sample_size, random_state=random_state)["ticker"]
-        case "Industry":
-            industry_counts = df_results['Industry'].value_counts()
-            selected_industries = industry_counts.sample(min(11, sample_size), random_state=random_state).index.tolist()
-            industry_grouped_portfolio = df_results[df_results['Industry'].isin(selected_industries)].groupby('Industry').apply(
-                lambda x: x.sample(1, random_state=random_state)
-            ).reset_index(drop=True)
-            additional_industries = industry_counts[~industry_counts.index.isin(selected_industries)].sample(max(0, sample_size - 11), random_state=random_state).index.tolist()
-            additional_stocks = df_results[df_results['Industry'].isin(additional_industries)].groupby('Industry').apply(
-                lambda x: x.sample(1, random_state=random_state)
-            ).reset_index(drop=True)
-            industry_grouped_portfolio = pd.concat([industry_grouped_portfolio, additional_stocks]).reset_index(drop=True)
-            return industry_grouped_portfolio["ticker"]
-        case "Base":
-            base_portfolio = df_results.groupby('cluster').apply(
-                lambda x: x.sample(min(len(x), 3), random_state=random_state),
-                include_groups=False
-            ).reset_index(drop=True)
-            if len(base_portfolio) < sample_size:
-                additional_stocks = df_results[~df_results['ticker'].isin(base_portfolio['ticker'])].sample(
-                    sample_size - len(base_portfolio), random_state=random_state
-                )
-                base_portfolio = pd.concat([base_portfolio, additional_stocks]).reset_index(drop=True)
-            return base_portfolio["ticker"]
-        case "Base-High":
-            base_high = df_results.groupby('cluster').apply(
-                lambda x: x.nlargest(3, 'risk'),
-                include_groups=False
-            ).reset_index(drop=True)
-            if len(base_high) < sample_size:
-                additional_stocks = df_results[~df_results['ticker'].isin(base_high['ticker'])].nlargest(
-                    sample_size - len(base_high), 'risk'
-                )
-                base_high = pd.concat([base_high, additional_stocks]).reset_index(drop=True)
-            return base_high["ticker"]
-        case "Base-Low":
-            base_low = df_results.groupby('cluster').apply(
-                lambda x: x.nsmallest(3, 'risk'),
-                include_groups=False
-            ).reset_index(drop=True)
-            if len(base_low) < sample_size:
-                additional_stocks = df_results[~df_results['ticker'].isin(base_low['ticker'])].nsmallest(
-                    sample_size - len(base_low), 'risk'
-                )
-                base_low = pd.concat([base_low, additional_stocks]).reset_index(drop=True)
-            return base_low["ticker"]
-        case "LowRisk":
-            low_risk_portfolio = df_results[df_results["risk"] < df_results["risk"].quantile(0.33)].sample(sample_size, random_state=random_state)
-            return low_risk_portfolio["ticker"]
-        case "MediumRisk":
-            med_df = df_results[
-                (df_results["risk"] >= df_results["risk"].quantile(0.34)) & 
-                (df_results["risk"] < df_results["risk"].quantile(0.66))
-            ]
-            med_risk_portfolio = med_df.sample(min(sample_size, len(med_df)), random_state=random_state)
-            return med_risk_portfolio["ticker"]
-        case "HighRisk":
-            high_risk_portfolio = df_results[df_results["risk"] >= df_results["risk"].quantile(0.67)].sample(sample_size, random_state=random_state)
-            return high_risk_portfolio["ticker"]
-        case _:
-            raise ValueError(f"Unknown policy: {policy}")
+class TickerSampler:
+    """
+    Draws ticker samples for each policy type.
+
+    Group memberships and risk buckets are computed once from df_results, so each
+    simulation only pays for the random draws themselves.
+    """
+
+    def __init__(self, df_results):
+        self.tickers = df_results["ticker"].to_numpy()
+        positions = np.arange(len(df_results))
+        cluster = df_results["cluster"].to_numpy()
+        industry = df_results["Industry"].to_numpy()
+        risk = df_results["risk"].to_numpy()
+
+        self.by_cluster = {c: positions[cluster == c] for c in np.unique(cluster)}
+        self.by_industry = {name: positions[industry == name] for name in pd.unique(industry)}
+
+        # Flattened groups (each group a contiguous slice) so per-group draws are single vectorized calls
+        self.cluster_members, self.cluster_ids, self.cluster_starts, self.cluster_sizes = self._flatten(self.by_cluster)
+        self.industry_members, _, self.industry_starts, self.industry_sizes = self._flatten(self.by_industry)
+
+        # Positions ordered by risk (stable, so ties keep row order like nlargest/nsmallest)
+        self.risk_desc = np.argsort(-risk, kind="stable")
+        self.risk_asc = np.argsort(risk, kind="stable")
+        self.cluster_high = np.concatenate([idx[np.argsort(-risk[idx], kind="stable")[:3]] for idx in self.by_cluster.values()])
+        self.cluster_low = np.concatenate([idx[np.argsort(risk[idx], kind="stable")[:3]] for idx in self.by_cluster.values()])
+
+        # All risk bucket boundaries from a single sort
+        q33, q34, q66, q67 = np.nanquantile(risk, [0.33, 0.34, 0.66, 0.67])
+        self.risk_low_idx = positions[risk < q33]
+        self.risk_med_idx = positions[(risk >= q34) & (risk < q66)]
+        self.risk_high_idx = positions[risk >= q67]
+
+    def sample(self, policy="Industry", sample_size=15, random_state=42):
+        rng = np.random.default_rng(random_state)
+        match policy:
+            case "Random":
+                chosen = rng.choice(len(self.tickers), size=sample_size, replace=False)
+            case "Industry":
+                # One stock from each of sample_size distinct industries
+                picked = rng.choice(len(self.industry_sizes), size=sample_size, replace=False)
+                offsets = rng.integers(0, self.industry_sizes[picked])
+                chosen = self.industry_members[self.industry_starts[picked] + offsets]
+            case "Base":
+                # Up to 3 per cluster: shuffle within clusters via random sort keys, keep the first 3 of each
+                order = np.lexsort((rng.random(len(self.cluster_members)), self.cluster_ids))
+                rank = np.arange(len(order)) - np.repeat(self.cluster_starts, self.cluster_sizes)
+                chosen = self.cluster_members[order][rank < 3]
+                if len(chosen) < sample_size:
+                    rest = np.setdiff1d(np.arange(len(self.tickers)), chosen)
+                    chosen = np.concatenate([chosen, rng.choice(rest, size=sample_size - len(chosen), replace=False)])
+            case "Base-High":
+                chosen = self._fill_by_rank(self.cluster_high, self.risk_desc, sample_size)
+            case "Base-Low":
+                chosen = self._fill_by_rank(self.cluster_low, self.risk_asc, sample_size)
+            case "LowRisk":
+                chosen = rng.choice(self.risk_low_idx, size=sample_size, replace=False)
+            case "MediumRisk":
+                chosen = rng.choice(self.risk_med_idx, size=min(sample_size, len(self.risk_med_idx)), replace=False)
+            case "HighRisk":
+                chosen = rng.choice(self.risk_high_idx, size=sample_size, replace=False)
+            case _:
+                raise ValueError(f"Unknown policy: {policy}")
+        return self.tickers[chosen]
+
+    @staticmethod
+    def _flatten(groups):
+        sizes = np.array([len(idx) for idx in groups.values()])
+        starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        members = np.concatenate(list(groups.values()))
+        return members, np.repeat(np.arange(len(sizes)), sizes), starts, sizes
+
+    @staticmethod
+    def _fill_by_rank(chosen, ranked, sample_size):
+        if len(chosen) >= sample_size:
+            return chosen
+        rest = ranked[~np.isin(ranked, chosen)]
+        return np.concatenate([chosen, rest[:sample_size - len(chosen)]])
 
 def extract_return(wealth_index, start_date, end_date):
     start_val = wealth_index.loc[start_date, wealth_index.columns[0]]
@@ -96,20 +123,24 @@ def extract_return(wealth_index, start_date, end_date):
     years = (ed - sd).days / 365.25
     annual = (end_val / start_val) ** (1 / years) - 1
 
-    yoy = {}
-    for year in range(int(start_date[:4]), int(end_date[:4])):
-        d1, d2 = f"{year}-12", f"{year+1}-12"
-        try:
-            ret = wealth_index.loc[d2, wealth_index.columns[0]] / wealth_index.loc[d1, wealth_index.columns[0]] - 1
-        except Exception:
-            ret = None
-        yoy[f"{year}-{year+1}"] = ret
+    # December-to-December returns for every year in the window; missing Decembers give None
+    col = wealth_index[wealth_index.columns[0]]
+    december = col[col.index.month == 12]
+    december.index = december.index.year
+    december = december.reindex(range(int(start_date[:4]), int(end_date[:4]) + 1))
+    yoy_series = (december / december.shift(1) - 1).iloc[1:]
+    yoy = {f"{year-1}-{year}": (None if pd.isna(ret) else ret) for year, ret in yoy_series.items()}
 
     return overall, annual, yoy
 
 # update signature: require sample_size
-def build_portfolio(policy_type, sample_size, random_state=42):
-    tickers = ticker_policy(df_results, policy_type, sample_size, random_state)
+def build_portfolio(sampler, policy_type, sample_size, random_state=42):
+    tickers = sampler.sample(policy_type, sample_size, random_state)
+    return _portfolio_for(tuple(sorted(tickers)))
+
+# Portfolios are treated as read-only, so simulations drawing the same tickers share one
+@lru_cache(maxsize=128)
+def _portfolio_for(tickers):
     assets = [f"{ticker}.US" for ticker in tickers]
     weights = [1/len(assets)] * len(assets)
     return ok.Portfolio(
@@ -121,10 +152,15 @@ def build_portfolio(policy_type, sample_size, random_state=42):
         last_date='2024-02'
     )
 
+# Historical wealth index per ticker set; repeated draws of the same set reuse the download
+@lru_cache(maxsize=256)
+def _wealth_index_for(tickers):
+    return _portfolio_for(tuple(sorted(tickers))).wealth_index
+
 # update to accept sample_size & length
 def simulate_return(i, policy_type, sample_size, sim_length):
     years = _parse_length_to_years(sim_length)
-    pf = build_portfolio(policy_type, sample_size, random_state=i)
+    pf = build_portfolio(_sampler, policy_type, sample_size, random_state=i)
     # if less than 1 year, simulate full 1‑year path and pick month
     if years < 1:
         months = int(years * 12)
@@ -146,15 +182,54 @@ def simulate_return(i, policy_type, sample_size, sim_length):
         "yoy_returns": {}
     }
 
+# Growth, overall and annualized returns for arrays of start/end wealth values
+def _growth_stats(start_vals, end_vals, years):
+    growth = end_vals / start_vals
+    return growth, growth - 1.0, growth ** (1.0 / years) - 1.0
+
+# numba is optional: when installed, JIT-compile the stats into one fused loop
+try:
+    from numba import njit
+    _growth_stats = njit(cache=True, fastmath=True)(_growth_stats)
+except ImportError:
+    pass
+
+# Monte Carlo for seed-invariant policies: every path comes from one portfolio
+def simulate_return_batch(sampler, policy_type, sample_size, sim_length, num_simulations):
+    years = _parse_length_to_years(sim_length)
+    pf = build_portfolio(sampler, policy_type, sample_size)
+    # if less than 1 year, simulate full 1‑year paths and pick month
+    if years < 1:
+        months = int(years * 12)
+        wealth = pf.monte_carlo_wealth(distr='norm', years=1, n=num_simulations)
+        end_vals = wealth.iloc[months].to_numpy()
+    else:
+        wealth = pf.monte_carlo_wealth(distr='norm', years=int(years), n=num_simulations)
+        end_vals = wealth.iloc[-1].to_numpy()
+    start_vals = wealth.iloc[0].to_numpy(dtype=np.float64)
+    growth, overall, ann = _growth_stats(start_vals, end_vals.astype(np.float64), float(years))
+    return [
+        {
+            "start_value": 10000,
+            "end_value":   10000 * g,
+            "overall_ret": o,
+            "ann_ret":     a,
+            "yoy_returns": {}
+        }
+        for g, o, a in zip(growth.tolist(), overall.tolist(), ann.tolist())
+    ]
+
 # update to accept sample_size & length
-def simulate_bootstrap(i, policy_type, sample_size, sim_length):
-    pf = build_portfolio(policy_type, sample_size, random_state=i)
-    wealth = pf.wealth_index
+def simulate_bootstrap(i, seed, policy_type, sample_size, sim_length):
+    tickers = _sampler.sample(policy_type, sample_size, random_state=i)
+    wealth = _wealth_index_for(frozenset(tickers))
     # total months from simulation_length
     total_months = int(_parse_length_to_years(sim_length) * 12)
     idx = wealth.index.to_timestamp()
     max_start = len(idx) - total_months - 1
-    start_pos = np.random.randint(0, max_start + 1)
+    # seed is a SeedSequence child spawned in main: forked workers would otherwise share
+    # one global RNG state, and it keeps the window independent of i and of the tickers
+    start_pos = np.random.default_rng(seed).integers(0, max_start + 1)
     start_date = idx[start_pos].strftime("%Y-%m")
     end_date   = idx[start_pos + total_months].strftime("%Y-%m")
     overall, ann, yoy = extract_return(wealth, start_date, end_date)
@@ -169,29 +244,32 @@ def simulate_bootstrap(i, policy_type, sample_size, sim_length):
         "yoy_returns": yoy
     }
 
+def _run_in_pool(simulate, sampler, *iterables, **kwargs):
+    # The simulations are CPU-bound NumPy/pandas work, so use processes rather than threads
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker, initargs=(sampler,)) as executor:
+        return list(executor.map(partial(simulate, **kwargs), *iterables))
+
 def main(policy_type, num_simulations, simulation_type, simulation_length, num_stocks):
     start_time = time.perf_counter()
+    sampler = TickerSampler(df_results)
 
-    with ThreadPoolExecutor() as executor:
-        if simulation_type == "monte_carlo":
-            results = list(
-                executor.map(
-                    lambda i: simulate_return(i, policy_type, num_stocks, simulation_length),
-                    range(num_simulations),
-                )
-            )
-            results_series = pd.Series(results)
-            print(results_series)
-        elif simulation_type == "bootstrap":
-            results = list(
-                executor.map(
-                    lambda i: simulate_bootstrap(i, policy_type, num_stocks, simulation_length),
-                    range(num_simulations),
-                )
-            )
-            print(pd.DataFrame(results).head())  # Just print a preview
+    if simulation_type == "monte_carlo":
+        if policy_type in SEED_INVARIANT_POLICIES:
+            # Same tickers for every seed: one portfolio, all paths in one call
+            results = simulate_return_batch(sampler, policy_type, num_stocks, simulation_length, num_simulations)
         else:
-            raise ValueError(f"Unknown simulation type: {simulation_type}")
+            results = _run_in_pool(simulate_return, sampler, range(num_simulations),
+                                   policy_type=policy_type, sample_size=num_stocks, sim_length=simulation_length)
+        results_series = pd.Series(results)
+        print(results_series)
+    elif simulation_type == "bootstrap":
+        # One independent, freshly seeded stream per simulation for the start month
+        seeds = np.random.SeedSequence().spawn(num_simulations)
+        results = _run_in_pool(simulate_bootstrap, sampler, range(num_simulations), seeds,
+                               policy_type=policy_type, sample_size=num_stocks, sim_length=simulation_length)
+        print(pd.DataFrame(results).head())  # Just print a preview
+    else:
+        raise ValueError(f"Unknown simulation type: {simulation_type}")
 
     save_portfolio_results(
         portfolio_name=f"{policy_type.lower()}_{simulation_length}_{num_stocks}s_portfolio",
@@ -200,7 +278,7 @@ def main(policy_type, num_simulations, simulation_type, simulation_length, num_s
     )
 
     elapsed = time.perf_counter() - start_time
-    print(f"With threads executed in {elapsed:0.2f} seconds.")
+    print(f"Executed in {elapsed:0.2f} seconds.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run simulations with a specified policy type.")
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
+from collections import namedtuple
 import pandas as pd
 import numpy as np
 import okama as ok
-from scipy.stats import zscore
+from scipy.cluster.hierarchy import dendrogram, fcluster, linkage
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.preprocessing import RobustScaler
-from sklearn.decomposition import PCA
+from tools import load_df_results, memory
 
 # Define the universe of 50 tickers split among 11 sectors.
 # For 6 sectors, we'll include 5 tickers each, and for the remaining 5 sectors, 4 tickers each.
@@ -59,36 +61,68 @@ stocks = {
     ]
 }
 
+# Fixed sector categories, in the order they appear in the universe above.
+SECTORS = [
+    'Technology', 'Healthcare', 'Financials', 'Consumer Discretionary', 'Consumer Staples', 'Energy',
+    'Industrials', 'Utilities', 'Materials', 'Communication Services', 'Real Estate'
+]
+
+# The ticker universe as a DataFrame, built once; Sector is categorical so groupby/get_dummies use integer codes.
+STOCKS_DF = pd.DataFrame({
+    'Ticker': stocks['Ticker'],
+    'Sector': pd.Categorical(stocks['Sector'], categories=SECTORS),
+})
+
+# Ratio columns summed (as z-scores) into each composite metric.
+RATIO_GROUPS = {
+    "profitability": ["net_profit_margin", "gross_profit_margin", "roa", "roe"],
+    "liquidity": ["current_ratio", "quick_ratio", "cash_ratio"],
+    "efficiency": ["inventory_turnover", "accounts_receivable_turnover", "asset_turnover"],
+    "market_value": ["pe_ratio", "pb_ratio", "dividend_yield"],
+    "leverage": ["debt_to_equity", "debt_ratio", "interest_coverage_ratio"],
+}
+# All ratio columns, group by group, and the offset where each group starts in that list.
+ALL_RATIO_COLS = [col for cols in RATIO_GROUPS.values() for col in cols]
+RATIO_GROUP_STARTS = np.cumsum([0] + [len(cols) for cols in RATIO_GROUPS.values()])[:-1]
+
 # ---------------------------
 # Function: Data Encoding & Cleanup
 # ---------------------------
-def setup_data(df_results):
-    df_encoded = pd.get_dummies(df_results, drop_first=True)
+def setup_data(df_results, encode_categoricals=True):
+    cat_cols = df_results.select_dtypes(include=["object", "category"]).columns
+    # PCA only reads numeric columns, so callers that don't need dummies can skip the encoding
+    encode = encode_categoricals and len(cat_cols) > 0
+    # drop() already returns a new frame; only copy when the categoricals are kept as-is
+    df_encoded = df_results.drop(columns=cat_cols) if encode else df_results.copy()
+
     numeric_cols = df_encoded.select_dtypes(include=np.number).columns
-    df_encoded[numeric_cols] = df_encoded[numeric_cols].fillna(df_encoded[numeric_cols].mean())
+    # Mean-impute NaNs in one pass over a NumPy copy, writing back only the columns that had gaps
+    X = df_encoded[numeric_cols].to_numpy(dtype=np.float64)
+    rows, cols = np.where(np.isnan(X))
+    if len(rows):
+        X[rows, cols] = np.take(np.nanmean(X, axis=0), cols)
+        filled = np.unique(cols)
+        df_encoded[numeric_cols[filled]] = X[:, filled]
+
+    if encode:
+        dummies = pd.get_dummies(df_results[cat_cols], drop_first=True, sparse=True, dtype=np.uint8)
+        df_encoded = pd.concat([df_encoded, dummies], axis=1)
     print(f"df_encoded ready: shape {df_encoded.shape}")
     return df_encoded
 
-def compute_risk(df_results):
-    all_assets = ok.AssetList([ticker + ".US" for ticker in df_results["ticker"]])
+# Rolling risks depend only on the ticker set and date range, so cache them on disk across runs
+@memory.cache
+def _fetch_rolling_risks(tickers, first_date=None, last_date=None):
+    all_assets = ok.AssetList([f"{ticker}.US" for ticker in tickers], first_date=first_date, last_date=last_date)
     
-    pf = ok.Portfolio(
-        assets=all_assets,
-        weights=[1 / len(all_assets)] * len(all_assets),    
-        ccy='USD',
-        rebalancing_period='month',  # 'Q' for quarterly, 'A' for annual, etc.
-        first_date='2004-01',    # pick a reasonable start date (earliest is 2003-09 from initial assessment)
-        last_date='2024-02'       # pick an end date to evaluate
-    )
-    
-    # Calculate the rolling annual risk for each asset
-    rolling_risks = all_assets.get_rolling_risk_annual()
-
-    risks = {}
+    # Calculate the rolling annual risk for each asset and keep the first window
+    first_risk = all_assets.get_rolling_risk_annual().iloc[0]
+    first_risk.index = first_risk.index.str.removesuffix(".US")
+    return first_risk.to_dict()
 
-    # Calculate the average rolling risk for each asset
-    for asset in all_assets:
-        risks[asset.ticker] = rolling_risks[asset.ticker + ".US"][0]
+def compute_risk(df_results):
+    # Sorted tuple keeps the cache key independent of row order
+    risks = _fetch_rolling_risks(tuple(sorted(df_results["ticker"].to_numpy())))
 
     # Map the calculated risks to the "ticker" column in df_results
     df_results["risk"] = df_results["ticker"].map(risks)
@@ -99,42 +133,31 @@ def compute_risk(df_results):
 def compute_composite_metrics(df_results):
     lower = -5
     upper = 5
-    def zscore_with_zero(series):
-        series = pd.to_numeric(series, errors='coerce')
-        z = zscore(series, nan_policy='omit')
-        z = np.clip(z, lower, upper)
-        return pd.Series(z, index=series.index).fillna(0)
-    
-    profitability = (zscore_with_zero(df_results["net_profit_margin"]) +
-                     zscore_with_zero(df_results["gross_profit_margin"]) +
-                     zscore_with_zero(df_results["roa"]) +
-                     zscore_with_zero(df_results["roe"]))
-    
-    liquidity = (zscore_with_zero(df_results["current_ratio"]) +
-                 zscore_with_zero(df_results["quick_ratio"]) +
-                 zscore_with_zero(df_results["cash_ratio"]))
-    
-    efficiency = (zscore_with_zero(df_results["inventory_turnover"]) +
-                  zscore_with_zero(df_results["accounts_receivable_turnover"]) +
-                  zscore_with_zero(df_results["asset_turnover"]))
-    
-    market_value = (zscore_with_zero(df_results["pe_ratio"]) +
-                    zscore_with_zero(df_results["pb_ratio"]) +
-                    zscore_with_zero(df_results["dividend_yield"]))
+    # Resolve the ratio columns to positions once, then select them in a single take
+    positions = df_results.columns.get_indexer(ALL_RATIO_COLS)
+    if (positions < 0).any():
+        missing = [col for col, pos in zip(ALL_RATIO_COLS, positions) if pos < 0]
+        raise KeyError(f"Missing ratio columns: {missing}")
+
+    # Z-score every ratio column at once (population std, NaNs ignored), clip, and zero out NaNs
+    X = df_results.take(positions, axis=1).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+    mu = np.nanmean(X, axis=0, keepdims=True)
+    sd = np.nanstd(X, axis=0, ddof=0, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z = np.clip((X - mu) / sd, lower, upper)
+    Z[np.isnan(Z)] = 0.0
     
-    leverage = (zscore_with_zero(df_results["debt_to_equity"]) +
-                zscore_with_zero(df_results["debt_ratio"]) +
-                zscore_with_zero(df_results["interest_coverage_ratio"]))
+    # Each group's columns are contiguous in Z, so one reduceat sums all five composites
+    composite = np.add.reduceat(Z, RATIO_GROUP_STARTS, axis=1)
     
-    scaler = RobustScaler()
-    df_results["profitability"] = scaler.fit_transform(profitability.values.reshape(-1, 1))
-    df_results["liquidity"]     = scaler.fit_transform(liquidity.values.reshape(-1, 1))
-    df_results["efficiency"]    = scaler.fit_transform(efficiency.values.reshape(-1, 1))
-    df_results["market_value"]  = scaler.fit_transform(market_value.values.reshape(-1, 1))
-    df_results["leverage"]      = scaler.fit_transform(leverage.values.reshape(-1, 1))
+    # RobustScaler scales each column independently, so one fit covers all five composites
+    df_results[list(RATIO_GROUPS)] = RobustScaler().fit_transform(composite)
     
     return df_results
 
+# Fitted PCA attributes returned by perform_pca (the subset of sklearn's PCA that callers read).
+PCAResult = namedtuple("PCAResult", ["components_", "explained_variance_", "explained_variance_ratio_", "mean_"])
+
 # ---------------------------
 # Function: Perform Principal Component Analysis (PCA)
 # ---------------------------
@@ -142,42 +165,97 @@ def perform_pca(df_encoded, columns=None, n_components=2):
     if columns is None:
         columns = ["profitability", "liquidity", "efficiency", "market_value", "leverage"]
     
-    scaler = RobustScaler()
-    scaled_data = scaler.fit_transform(df_encoded[columns])
+    # One C-contiguous float64 copy feeds both the scaler (in place) and the covariance product
+    X = np.ascontiguousarray(df_encoded[columns].to_numpy(dtype=np.float64))
+    scaler = RobustScaler(copy=False)
+    scaled_data = scaler.fit_transform(X)
     
-    pca_model = PCA(n_components=n_components)
-    projected = pca_model.fit_transform(scaled_data)
+    # With only a handful of features, eigendecomposing the small covariance matrix
+    # is far cheaper than an SVD of the full data matrix
+    mean = scaled_data.mean(axis=0)
+    centered = scaled_data - mean
+    cov = (centered.T @ centered) / (centered.shape[0] - 1)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    top = np.argsort(eigvals)[::-1][:n_components]
+    components = eigvecs[:, top].T
+    # Fix the sign of each component (largest loading positive), like sklearn's svd_flip
+    signs = np.sign(components[np.arange(len(top)), np.abs(components).argmax(axis=1)])
+    components *= signs[:, np.newaxis]
+    projected = centered @ components.T
+    
+    pca_model = PCAResult(
+        components_=components,
+        explained_variance_=eigvals[top],
+        explained_variance_ratio_=eigvals[top] / eigvals.sum(),
+        mean_=mean,
+    )
     
     print(f"PCA complete: projected data shape {projected.shape}")
     return projected, pca_model
 
-def compute_clusters(df, projectedData, n_clusters=5, random_state=0, method="kmeans"):
-    match (method):
-        case "kmeans":
-            from sklearn.cluster import KMeans
-            model = KMeans(n_clusters=n_clusters, random_state=random_state)
-            kmeans = model.fit_predict(projectedData)
-            df["cluster"] = kmeans
-
-        case "dendrogram":
-            from scipy.cluster.hierarchy import dendrogram, linkage, fcluster
-            Z = linkage(projectedData, method='ward')
-            # Compute threshold to color the dendrogram for exactly n_clusters segments
-            cluster_threshold = Z[-(n_clusters - 1), 2] if n_clusters > 1 else 0
-            dendrogram(Z, labels=df["ticker"].tolist(), color_threshold=cluster_threshold)
-
-            # Add matplotlib adjustments: remove y-axis numbers, add x-axis label and title
-            import matplotlib.pyplot as plt
-            plt.xlabel("Ticker")
-            plt.title("Dendrogram of Stocks")
-            plt.gca().set_yticklabels([])  # Remove y-axis numbers
-            plt.show()
-
-            # Force exactly n_clusters using "maxclust"
-            clusters = fcluster(Z, t=n_clusters, criterion='maxclust')
-            df["cluster"] = clusters
-        case _:
-            raise ValueError(f"Invalid method: {method}. Use 'kmeans' or 'dendrogram'.")
+# Above this many rows, compute_clusters switches to mini-batch k-means.
+MINIBATCH_KMEANS_MIN_ROWS = 10_000
+
+# matplotlib is only needed for plots, so it is imported on first use
+_plt = None
+
+def _get_plt():
+    global _plt
+    if _plt is None:
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
+def _ward_linkage(projectedData):
+    # Leaf reordering only matters for drawing, so it is never run here
+    return linkage(np.ascontiguousarray(projectedData, dtype=np.float64), method='ward', optimal_ordering=False)
+
+def plot_dendrogram(Z, labels, n_clusters=5):
+    plt = _get_plt()
+    # Compute threshold to color the dendrogram for exactly n_clusters segments
+    cluster_threshold = Z[-(n_clusters - 1), 2] if n_clusters > 1 else 0
+    dendrogram(Z, labels=labels, color_threshold=cluster_threshold)
+
+    # Add matplotlib adjustments: remove y-axis numbers, add x-axis label and title
+    plt.xlabel("Ticker")
+    plt.title("Dendrogram of Stocks")
+    plt.gca().set_yticklabels([])  # Remove y-axis numbers
+    plt.show()
+
+# Clustering methods available to compute_clusters, keyed by method name.
+_CLUSTER_METHODS = {}
+
+def _register(name):
+    def decorator(fn):
+        _CLUSTER_METHODS[name] = fn
+        return fn
+    return decorator
+
+@_register("kmeans")
+def _kmeans_clusters(df, projectedData, n_clusters, random_state, plot):
+    data = np.ascontiguousarray(projectedData, dtype=np.float32)
+    # A single k-means++ start is plenty on low-dimensional PCA output
+    if len(data) > MINIBATCH_KMEANS_MIN_ROWS:
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, n_init=1, batch_size=256)
+    else:
+        model = KMeans(n_clusters=n_clusters, random_state=random_state, n_init=1, algorithm='lloyd')
+    return model.fit_predict(data)
+
+@_register("dendrogram")
+def _dendrogram_clusters(df, projectedData, n_clusters, random_state, plot):
+    Z = _ward_linkage(projectedData)
+    # Drawing is optional so headless callers skip matplotlib entirely
+    if plot:
+        plot_dendrogram(Z, df["ticker"].tolist(), n_clusters)
+
+    # Force exactly n_clusters using "maxclust"
+    return fcluster(Z, t=n_clusters, criterion='maxclust')
+
+def compute_clusters(df, projectedData, n_clusters=5, random_state=0, method="kmeans", plot=True):
+    cluster_fn = _CLUSTER_METHODS.get(method)
+    if cluster_fn is None:
+        raise ValueError(f"Invalid method: {method}. Use {' or '.join(repr(name) for name in _CLUSTER_METHODS)}.")
+    df["cluster"] = cluster_fn(df, projectedData, n_clusters, random_state, plot)
 
     return df
 
@@ -189,10 +267,10 @@ def compute_clusters(df, projectedData, n_clusters=5, random_state=0, method="km
 def main():
     print("Loading df_results...")
     # Replace with the actual data loading as needed.
-    df_results = pd.read_csv("df_results.csv")
+    df_results = load_df_results("df_results.csv")
     print(f"Data loaded: df_results shape {df_results.shape}")
     
-    df_encoded = setup_data(df_results)
+    df_encoded = setup_data(df_results, encode_categoricals=False)
     df_results = compute_composite_metrics(df_results)
     
     pca_cols = ["profitability", "liquidity", "efficiency", "market_value", "leverage"]
@@ -1,35 +1,194 @@
+import io
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-# Try importing pandas, but make it optional unless absolutely needed
+import numpy as np
 import pandas as pd
+from joblib import Memory
+# orjson is optional: a faster (de)serializer that also handles NumPy values; falls back to json
 try:
-    import pandas as pd
-    PANDAS_AVAILABLE = True
+    import orjson
+    ORJSON_AVAILABLE = True
 except ImportError:
-    PANDAS_AVAILABLE = False
-    print("Warning: pandas library not found. Monte Carlo result retrieval as Series will not be available.")
+    ORJSON_AVAILABLE = False
+
+# Single on-disk cache shared by every module, so there is one directory to clear
+CACHE_DIR = ".cache"
+memory = Memory(CACHE_DIR, verbose=0)
+
+# Results are written in few large chunks rather than many small ones
+WRITE_BUFFER_SIZE = io.DEFAULT_BUFFER_SIZE * 4
+# Up to this many portfolios, converting results serially beats starting a thread pool
+PARALLEL_CONVERT_MIN_PORTFOLIOS = 8
+
+def load_df_results(csv_path="df_results.csv"):
+    """
+    Load df_results, reusing a Parquet copy of the CSV when it is up to date.
+    
+    The first load after the CSV changes converts it to Parquet (Snappy, with
+    Industry stored as a categorical and cluster as int8); later loads read the
+    columnar file instead of re-parsing the CSV.
+    
+    Parameters:
+        csv_path (str): Path to the df_results CSV file.
+    
+    Returns:
+        pd.DataFrame: The loaded df_results.
+    """
+    parquet_path = os.path.splitext(csv_path)[0] + ".parquet"
+    # Reuse the Parquet file only if it was written after the CSV was last modified
+    if os.path.exists(parquet_path) and (
+        not os.path.exists(csv_path) or os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path)
+    ):
+        return pd.read_parquet(parquet_path)
+    df_results = pd.read_csv(csv_path)
+    dtypes = {"Industry": "category", "cluster": "int8"}
+    df_results = df_results.astype({col: dtype for col, dtype in dtypes.items() if col in df_results.columns})
+    try:
+        df_results.to_parquet(parquet_path, compression="snappy")
+    except (OSError, ImportError) as e:
+        print(f"Warning: Could not convert {csv_path} to {parquet_path}: {e}")
+    return df_results
+
+def _default_results_path(simulation, warn=False):
+    """Default results log for a simulation type, in '../data/' relative to tools.py or else './data'."""
+    # Define default file paths (adjust '../data/' if needed)
+    base_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
+    if not os.path.exists(base_dir):
+        base_dir = "./data" # Fallback to current directory subfolder 'data'
+        if warn:
+            print(f"Warning: Default directory '../data/' not found relative to tools.py. Using '{base_dir}'.")
+    file_name = "monte_carlo_results.jsonl" if simulation == "monte_carlo" else "bootstrap_results.jsonl"
+    return os.path.join(base_dir, file_name)
+
+def _results_path(file_path):
+    """Results are stored as JSON Lines; map any given path to its .jsonl form."""
+    return os.path.splitext(file_path)[0] + ".jsonl"
+
+def _load_portfolios(file_path):
+    """
+    Rebuild the {portfolio_name: entry} dict from a JSON Lines results log.
+    
+    Each line holds one saved entry; later lines replace earlier ones with the same name.
+    If the log does not exist yet, falls back to a legacy single-document .json file.
+    Returns None if neither file exists.
+    """
+    # Open directly instead of checking for the file first; a missing log is the rare case
+    try:
+        file = open(file_path, "rb")
+    except FileNotFoundError:
+        return _load_legacy_portfolios(os.path.splitext(file_path)[0] + ".json")
+
+    all_portfolios = {}
+    with file:
+        for line_no, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = _loads_record(line)
+            except ValueError: # JSON or UTF-8 decode error
+                # e.g. a partially written last line from an interrupted save
+                print(f"Warning: Skipping invalid line {line_no} in {file_path}.")
+                continue
+            name = record.pop("name")
+            all_portfolios[name] = record
+    return all_portfolios
+
+def _load_legacy_portfolios(legacy_path):
+    """Read a legacy single-document .json results file in one go; None if missing or empty."""
+    try:
+        with open(legacy_path, "rb") as file:
+            raw = file.read()
+    except FileNotFoundError:
+        return None
+    return _loads_record(raw) if raw.strip() else None
+
+def _loads_record(line):
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass # e.g. NaN/Infinity written by the stdlib encoder, which orjson rejects
+    return json.loads(line)
+
+def _json_default(value):
+    """Fallback for values the stdlib encoder can't handle: NumPy scalars/arrays, else str (e.g. Timestamps)."""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    return str(value)
+
+def _dump_record(portfolio_name, entry):
+    """
+    Serialize one results entry to a newline-terminated UTF-8 JSON line.
+    
+    NaN/Infinity are written as NaN/Infinity (as the stdlib encoder always has), not null.
+    """
+    record = {"name": portfolio_name, **entry}
+    if ORJSON_AVAILABLE:
+        line = orjson.dumps(
+            record,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE,
+            default=str,
+        )
+        # orjson writes NaN as null; only lines with a null can be affected, so re-encode just those
+        if b"null" not in line:
+            return line
+    return (json.dumps(record, separators=(",", ":"), default=_json_default) + "\n").encode("utf-8")
+
+def _save_sidecar(file_path, portfolio_name, results):
+    """
+    Store flat numeric results as a .npy file in a directory next to the results log.
+    
+    Returns the file's path relative to the log's directory, or None if the results
+    are not a flat sequence of ints/floats (e.g. a list of result dicts, bools or numeric
+    strings), which stay inline so they round-trip unchanged.
+    """
+    try:
+        arr = np.asarray(results)
+    except (TypeError, ValueError):
+        return None
+    # No dtype coercion: only arrays NumPy infers as int or float go to the sidecar
+    if arr.ndim != 1 or arr.dtype.kind not in "if":
+        return None
+    data_dir = os.path.splitext(file_path)[0] + "_data"
+    os.makedirs(data_dir, exist_ok=True)
+    data_path = os.path.join(os.path.basename(data_dir), f"{portfolio_name}.npy")
+    np.save(os.path.join(os.path.dirname(file_path), data_path), arr)
+    return data_path
+
+def _load_sidecar(file_path, entry, as_mmap=False):
+    """Load an entry's .npy results as a pd.Series, memory-mapped read-only if as_mmap."""
+    arr = np.load(os.path.join(os.path.dirname(file_path), entry["data_path"]),
+                  mmap_mode="r" if as_mmap else None)
+    return pd.Series(arr, copy=False)
+
+def _with_sidecar_data(file_path, entry, as_mmap=False):
+    """Full entry with sidecar-backed results loaded into 'data' (as a pd.Series)."""
+    if "data_path" not in entry:
+        return entry
+    return {**entry, "data": _load_sidecar(file_path, entry, as_mmap)}
 
 def save_portfolio_results(portfolio_name, results, file_path=None, simulation="bootstrap"):
     """
-    Save portfolio results to a JSON file, organizing data by a detailed portfolio name.
+    Save portfolio results to a JSON Lines file, organizing data by a detailed portfolio name.
+    
+    Each save appends a single line, so its cost does not grow with the number of stored
+    portfolios. Re-saving a name supersedes the earlier line; see compact_portfolio_results.
+    Flat numeric Monte Carlo results are written to a sidecar .npy file that the line
+    references via 'data_path' instead of being stored inline.
     
     Parameters:
         portfolio_name (str): Unique name of the portfolio incorporating policy, stocks, duration, etc.
         results (list or dict): Results data to save. For Monte Carlo, often a list of returns.
                                 For Bootstrap, a list of dictionaries.
-        file_path (str, optional): Path to the JSON file. If None, defaults based on simulation type.
+        file_path (str, optional): Path to the results file (stored with a .jsonl extension).
+                                   If None, defaults based on simulation type.
         simulation (str): Simulation type, e.g. "bootstrap" or "monte_carlo". Default is "bootstrap".
     """
     if file_path is None:
-        # Define default file paths (adjust '../data/' if needed)
-        base_dir = os.path.join(os.path.dirname(__file__), '..', 'data') # Assumes tools.py is in a 'tools' subdir
-        if not os.path.exists(base_dir):
-             base_dir = "./data" # Fallback to current directory subfolder 'data'
-             print(f"Warning: Default directory '../data/' not found relative to tools.py. Using '{base_dir}'.")
-
-        file_path = os.path.join(base_dir, "monte_carlo_results.json") if simulation == "monte_carlo" \
-                    else os.path.join(base_dir, "bootstrap_results.json")
+        file_path = _default_results_path(simulation, warn=True)
+    file_path = _results_path(file_path)
     
     # Create directory if it doesn't exist
     try:
@@ -40,37 +199,41 @@ def save_portfolio_results(portfolio_name, results, file_path=None, simulation="
         # file_path = os.path.basename(file_path)
         # print(f"Attempting to save in current directory as {file_path}")
         # No, better to fail clearly if directory isn't writable/creatable.
-
-    # Initialize the data structure
-    all_portfolios = {}
-    
-    # Read existing data if file exists
-    if os.path.exists(file_path) and os.path.getsize(file_path) > 0: # Check size > 0
-        try:
-            with open(file_path, "r") as file:
-                all_portfolios = json.load(file)
-        except json.JSONDecodeError:
-            print(f"Warning: File {file_path} exists but is empty or contains invalid JSON. Starting fresh.")
-            all_portfolios = {}
-        except Exception as e:
-            print(f"Error reading existing results file {file_path}: {e}. Starting fresh.")
-            all_portfolios = {} # Avoid overwriting potentially recoverable data? Maybe backup first? For now, overwrite.
             
-    # Add timestamp and simulation metadata to results
-    # Note: The 'results' variable itself should be the primary data (list or dict)
-    results_with_meta = {
-        "data": results, # Store the actual results list/dict here
-        "simulation_type": simulation,
-        "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-    
-    # Update data for this specific portfolio run (using the detailed name as the key)
-    all_portfolios[portfolio_name] = results_with_meta
-    
-    # Write updated data back to file
+    # Append this portfolio run (keyed by the detailed name) to the log
     try:
-        with open(file_path, "w") as file:
-            json.dump(all_portfolios, file, indent=4, default=str) # Use default=str for non-serializable types like Timestamps if they sneak in
+        try:
+            # "r+b" fails if the log does not exist yet, so the common case costs a single open
+            file = open(file_path, "r+b", buffering=WRITE_BUFFER_SIZE)
+        except FileNotFoundError:
+            # First save to this log: carry results from a legacy .json file over before appending.
+            # Creating the log without them would hide the legacy results from every later read.
+            if not compact_portfolio_results(file_path=file_path):
+                print(f"Error: Legacy results could not be migrated to {file_path}; '{portfolio_name}' was not saved.")
+                return
+            file = open(file_path, "a+b", buffering=WRITE_BUFFER_SIZE)
+        with file:
+            data_path = _save_sidecar(file_path, portfolio_name, results) if simulation == "monte_carlo" else None
+
+            # Add timestamp and simulation metadata to results
+            # Note: The 'results' variable itself should be the primary data (list or dict)
+            results_with_meta = {
+                "simulation_type": simulation,
+                "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            if data_path is not None:
+                results_with_meta["data_path"] = data_path # Numeric results live in the sidecar .npy file
+            else:
+                results_with_meta["data"] = results # Store the actual results list/dict here
+
+            line = _dump_record(portfolio_name, results_with_meta) # default=str covers non-serializable types like Timestamps
+            # Terminate a partial last line left by an interrupted save, so only that line is lost
+            if file.seek(0, os.SEEK_END) > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    line = b"\n" + line
+            file.seek(0, os.SEEK_END)
+            file.write(line)
         print(f"Results for portfolio '{portfolio_name}' saved to {file_path}")
     except IOError as e:
          print(f"Error writing results to {file_path}: {e}")
@@ -78,39 +241,91 @@ def save_portfolio_results(portfolio_name, results, file_path=None, simulation="
          print(f"Error serializing results to JSON for {portfolio_name}. Ensure data is JSON compatible: {e}")
 
 
-def retrieve_portfolio_results(portfolio_name=None, file_path=None, simulation="bootstrap", data_only=True):
+def compact_portfolio_results(file_path=None, simulation="bootstrap"):
     """
-    Retrieve portfolio results from a JSON file using the detailed portfolio name.
+    Rewrite a results log with one line per portfolio, dropping superseded entries.
+    
+    Also migrates a legacy single-document .json results file into the .jsonl log.
+    
+    Parameters:
+        file_path (str, optional): Path to the results file. If None, defaults based on simulation type.
+        simulation (str): Simulation type ('bootstrap' or 'monte_carlo') to determine the default file.
+    
+    Returns:
+        bool: False if the existing results could not be read, True otherwise
+              (including when there was nothing to compact).
+    """
+    if file_path is None:
+        file_path = _default_results_path(simulation)
+    file_path = _results_path(file_path)
+
+    try:
+        all_portfolios = _load_portfolios(file_path)
+    except (ValueError, IOError) as e: # ValueError covers JSON and UTF-8 decode errors
+        print(f"Error reading results from {file_path}: {e}. Nothing compacted.")
+        return False
+    if all_portfolios is None:
+        return True
+
+    # Write to a temporary file first so an interrupted compaction never loses data
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as file:
+        for name, entry in all_portfolios.items():
+            file.write(_dump_record(name, entry))
+    os.replace(tmp_path, file_path)
+    return True
+
+
+def _numeric_series_batch(named_lists):
+    """
+    Build one pd.Series per (name, list) pair from a single float64 array.
+    
+    Returns None unless every list is numeric and all have the same length
+    (e.g. lists of result dicts), in which case callers convert entries one by one.
+    """
+    if len({len(data) for _, data in named_lists}) != 1:
+        return None
+    try:
+        arr = np.asarray([data for _, data in named_lists], dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    if arr.ndim != 2: # e.g. nested lists, which need the per-entry (object Series) path
+        return None
+    return {name: pd.Series(arr[i], copy=False) for i, (name, _) in enumerate(named_lists)}
+
+
+def retrieve_portfolio_results(portfolio_name=None, file_path=None, simulation="bootstrap", data_only=True, as_mmap=False):
+    """
+    Retrieve portfolio results from a JSON Lines file using the detailed portfolio name.
     
     Parameters:
         portfolio_name (str, optional): Unique name of the portfolio run to retrieve.
                                        If None, returns all portfolios from the file.
-        file_path (str, optional): Path to the JSON file. If None, defaults based on simulation type.
+        file_path (str, optional): Path to the results file. If None, defaults based on simulation type.
         simulation (str): Simulation type ('bootstrap' or 'monte_carlo') to determine the default file.
         data_only (bool): If True, returns just the 'data' part. If False, returns 
-                          the full entry including metadata.
+                          the full entry including metadata. For results stored in a
+                          sidecar .npy file, 'data' holds them as a pd.Series.
+        as_mmap (bool): If True, results stored in a sidecar .npy file are returned as a
+                        pd.Series over a read-only memory map instead of being read into memory.
     
     Returns:
         dict or list or pd.Series/pd.DataFrame: The requested portfolio data, or all portfolios.
               Returns None if the file or specific portfolio doesn't exist.
-              Returns specific types based on data_only and simulation type (and pandas availability).
+              Returns specific types based on data_only and simulation type.
     """
     if file_path is None:
-        base_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
-        if not os.path.exists(base_dir):
-             base_dir = "./data"
-        file_path = os.path.join(base_dir, "monte_carlo_results.json") if simulation == "monte_carlo" \
-                    else os.path.join(base_dir, "bootstrap_results.json")
-        
-    # Check if file exists
-    if not os.path.exists(file_path):
-        print(f"Warning: Results file {file_path} not found.")
-        return None
+        file_path = _default_results_path(simulation)
+    file_path = _results_path(file_path)
     
     try:
-        # Load all portfolios from the JSON file
-        with open(file_path, "r") as file:
-            all_portfolios = json.load(file)
+        # Load all portfolios from the results log
+        all_portfolios = _load_portfolios(file_path)
+        
+        # Check if file exists
+        if all_portfolios is None:
+            print(f"Warning: Results file {file_path} not found.")
+            return None
         
         # Return data for a specific portfolio run if requested
         if portfolio_name is not None:
@@ -121,54 +336,66 @@ def retrieve_portfolio_results(portfolio_name=None, file_path=None, simulation="
             portfolio_entry = all_portfolios[portfolio_name]
             
             if data_only:
+                if "data_path" in portfolio_entry:
+                    return _load_sidecar(file_path, portfolio_entry, as_mmap)
                 result_data = portfolio_entry.get("data") # Safely get data
-                # Try converting to pandas objects if appropriate and available
-                if PANDAS_AVAILABLE:
-                    sim_type = portfolio_entry.get("simulation_type", simulation) # Use stored sim type if available
-                    if sim_type == "monte_carlo" and isinstance(result_data, list):
-                         try:
-                             return pd.Series(result_data)
-                         except Exception as e:
-                              print(f"Warning: Could not convert Monte Carlo data to Series: {e}. Returning raw list.")
-                              return result_data
-                    elif sim_type == "bootstrap" and isinstance(result_data, list) and all(isinstance(item, dict) for item in result_data):
-                         try:
-                             return pd.DataFrame(result_data)
-                         except Exception as e:
-                              print(f"Warning: Could not convert Bootstrap data to DataFrame: {e}. Returning raw list of dicts.")
-                              return result_data
-                    else: # Return raw data if not MC list or Bootstrap list-of-dicts
-                        return result_data
-                else: # Pandas not available
+                # Try converting to pandas objects if appropriate
+                sim_type = portfolio_entry.get("simulation_type", simulation) # Use stored sim type if available
+                if sim_type == "monte_carlo" and isinstance(result_data, list):
+                     try:
+                         return pd.Series(result_data)
+                     except Exception as e:
+                          print(f"Warning: Could not convert Monte Carlo data to Series: {e}. Returning raw list.")
+                          return result_data
+                elif sim_type == "bootstrap" and isinstance(result_data, list) and all(isinstance(item, dict) for item in result_data):
+                     try:
+                         return pd.DataFrame(result_data)
+                     except Exception as e:
+                          print(f"Warning: Could not convert Bootstrap data to DataFrame: {e}. Returning raw list of dicts.")
+                          return result_data
+                else: # Return raw data if not MC list or Bootstrap list-of-dicts
                     return result_data
             else: # Return full entry with metadata
-                return portfolio_entry
+                return _with_sidecar_data(file_path, portfolio_entry, as_mmap)
         
         # Otherwise return all portfolios stored in the file
         else:
             if data_only:
-                processed_portfolios = {}
-                for name, entry in all_portfolios.items():
+                # Numeric Monte Carlo lists of equal length are converted together from one 2-D array
+                mc_lists = [(name, entry.get("data")) for name, entry in all_portfolios.items()
+                            if entry.get("simulation_type", simulation) == "monte_carlo" and isinstance(entry.get("data"), list)]
+                batched = (_numeric_series_batch(mc_lists) if len(mc_lists) > 1 else None) or {}
+
+                def convert(item):
+                    name, entry = item
+                    if "data_path" in entry:
+                        return name, _load_sidecar(file_path, entry, as_mmap)
                     result_data = entry.get("data")
-                    if PANDAS_AVAILABLE:
-                        sim_type = entry.get("simulation_type", simulation) # Default to function arg if not stored
-                        if sim_type == "monte_carlo" and isinstance(result_data, list):
-                             try:
-                                 processed_portfolios[name] = pd.Series(result_data)
-                             except Exception:
-                                 processed_portfolios[name] = result_data # Fallback
-                        elif sim_type == "bootstrap" and isinstance(result_data, list) and all(isinstance(item, dict) for item in result_data):
-                            try:
-                                processed_portfolios[name] = pd.DataFrame(result_data)
-                            except Exception:
-                                processed_portfolios[name] = result_data # Fallback
-                        else:
-                            processed_portfolios[name] = result_data
-                    else: # Pandas not available
-                         processed_portfolios[name] = result_data
+                    sim_type = entry.get("simulation_type", simulation) # Default to function arg if not stored
+                    if sim_type == "monte_carlo" and isinstance(result_data, list):
+                         try:
+                             return name, pd.Series(result_data)
+                         except Exception:
+                             return name, result_data # Fallback
+                    elif sim_type == "bootstrap" and isinstance(result_data, list) and all(isinstance(item, dict) for item in result_data):
+                        try:
+                            return name, pd.DataFrame(result_data)
+                        except Exception:
+                            return name, result_data # Fallback
+                    return name, result_data
+
+                pending = [(name, entry) for name, entry in all_portfolios.items() if name not in batched]
+                # Building the pandas objects is mostly NumPy work, so larger files convert in a thread pool
+                if len(pending) > PARALLEL_CONVERT_MIN_PORTFOLIOS:
+                    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                        converted = dict(executor.map(convert, pending))
+                else:
+                    converted = dict(map(convert, pending))
+                processed_portfolios = {name: batched[name] if name in batched else converted[name]
+                                        for name in all_portfolios}
                 return processed_portfolios
             else: # Return all full entries
-                return all_portfolios
+                return {name: _with_sidecar_data(file_path, entry, as_mmap) for name, entry in all_portfolios.items()}
                 
     except json.JSONDecodeError:
         print(f"Error: Could not parse {file_path} as valid JSON.")